@@ -1,16 +1,24 @@
 import numpy as np
 import os
 
-from keras.optimizers import Adam
-from utils.facades_generator import facades_generator
-from networks.generator import UNETGenerator
+# let cuDNN benchmark and pick the fastest conv algorithms. Already tensorflow's default, only made
+# explicit here (a value from the environment still wins, has to be set before tensorflow loads).
+# The picks are not persisted, every run benchmarks again on its first steps
+os.environ.setdefault('TF_CUDNN_USE_AUTOTUNE', '1')
+import tensorflow as tf
+
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras import mixed_precision
+from utils.facades_generator import facades_dataset
+from networks.generator import UNETGenerator, get_or_build_generator
 from networks.discriminator import PatchGanDiscriminator
 from networks.DCGAN import DCGAN
 from utils import patch_utils
 from utils import logger
 import time
 
-from keras.utils import generic_utils as keras_generic_utils
+from tensorflow.keras.utils import Progbar
+import tensorflow.keras.backend as K
 
 WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
 DATASET = 'facades_bw'
@@ -25,9 +33,36 @@ im_width = im_height = 256
 input_channels = 1
 output_channels = 1
 
-# image dims
-input_img_dim = (input_channels, im_width, im_height)
-output_img_dim = (output_channels, im_width, im_height)
+# 'mixed_float16' runs the convs on tensor cores (Volta+) with float32 weights,
+# 'mixed_bfloat16' does the same on Ampere+, 'float32' disables mixed precision
+precision_policy = 'mixed_float16'
+
+# let XLA cluster and fuse the ops of the training graphs
+use_xla = True
+
+# generator decoder upsampling. 'deconv' (paper) is a stride 2 transposed conv,
+# 'subpixel' a stride 1 conv followed by a pixel shuffle (see upsample_conv)
+gen_upsampling = 'deconv'
+
+# generator conv kernels. (4, 4) is the paper spec, (3, 3) is ~44% fewer FLOPs per conv.
+# Use (3, 3) with 'subpixel' upsampling: its stride 1 decoder convs are Winograd eligible in cuDNN,
+# with 'deconv' the stride 2 deconvs overlap unevenly and leave checkerboard artifacts
+gen_kernel_size = (4, 4)
+
+# deepest generator encoder blocks that recompute their activations in the
+# backward pass instead of keeping them in memory (gradient checkpointing).
+# Off until a memory gain is measured: at 256x256 the deep blocks are tiny (8x8 and less)
+# and their outputs are kept anyway as the next block input and as skips
+gen_recompute_encoders = 0
+
+# load the generator from a cached SavedModel instead of building it. The cached model
+# has the init of its first build, so every run would start from the same weights
+cache_generator = False
+
+# image dims (channels last, native layout of the tensorflow backend)
+K.set_image_data_format('channels_last')
+input_img_dim = (im_width, im_height, input_channels)
+output_img_dim = (im_width, im_height, output_channels)
 
 # We're using PatchGAN setup, so we need the num of non-overlaping patches
 # this is how big we'll make the patches for the discriminator
@@ -40,59 +75,82 @@ nb_patch_patches, patch_gan_dim = patch_utils.num_patches(output_img_dim=output_
 # TRAINING ROUTINE
 # ---------------------------------------------
 
-# ----------------------
-# GENERATOR
-# Our generator is an AutoEncoder with U-NET skip connections
-# ----------------------
-generator_nn = UNETGenerator(input_img_dim=input_img_dim, num_output_channels=output_channels)
-generator_nn.summary()
-
-# ----------------------
-# PATCH GAN DISCRIMINATOR
-# the patch gan averages loss across sub patches of the image
-# it's fancier than the standard gan but produces sharper results
-# ----------------------
-discriminator_nn = PatchGanDiscriminator(output_img_dim=output_img_dim,
-        patch_dim=patch_gan_dim, nb_patches=nb_patch_patches)
-discriminator_nn.summary()
-
-# disable training while we put it through the GAN
-discriminator_nn.trainable = False
-
-# ------------------------
-# Define Optimizers
-opt_discriminator = Adam(lr=1E-4, beta_1=0.9, beta_2=0.999, epsilon=1e-08)
-opt_dcgan = Adam(lr=1E-4, beta_1=0.9, beta_2=0.999, epsilon=1e-08)
-
-# -------------------------
-# compile generator
-generator_nn.compile(loss='mae', optimizer=opt_discriminator)
-
-# ----------------------
-# MAKE FULL DCGAN
-# ----------------------
-dc_gan_nn = DCGAN(generator_model=generator_nn,
-                  discriminator_model=discriminator_nn,
-                  input_img_dim=input_img_dim,
-                  patch_dim=sub_patch_dim)
-
-dc_gan_nn.summary()
-
-# ---------------------
-# Compile DCGAN
-# we use a combination of mae and bin_crossentropy
-loss = ['mae', 'binary_crossentropy']
-loss_weights = [1E2, 1]
-dc_gan_nn.compile(loss=loss, loss_weights=loss_weights, optimizer=opt_dcgan)
-
-# ---------------------
-# ENABLE DISCRIMINATOR AND COMPILE
-discriminator_nn.trainable = True
-discriminator_nn.compile(loss='binary_crossentropy', optimizer=opt_discriminator)
+# has to be set before any layer is built
+mixed_precision.set_global_policy(precision_policy)
+tf.config.optimizer.set_jit(use_xla)
+
+# replicate the networks on every visible GPU, each batch is split across them
+strategy = tf.distribute.MirroredStrategy()
+print('Number of replicas: {}'.format(strategy.num_replicas_in_sync))
+
+# images each replica trains on per step, the generator is built with it
+# as static batch dim so XLA can specialize on the shape
+batch_size_per_replica = 1
+
+# global batch, split evenly across the replicas
+batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+
+# all the networks, optimizers and compiles have to be created in the strategy scope
+with strategy.scope():
+    # ----------------------
+    # GENERATOR
+    # Our generator is an AutoEncoder with U-NET skip connections
+    # ----------------------
+    gen_params = dict(kernel_size=gen_kernel_size, upsampling=gen_upsampling,
+                      recompute_encoders=gen_recompute_encoders, batch_size=batch_size_per_replica)
+    if cache_generator:
+        generator_nn = get_or_build_generator(input_img_dim=input_img_dim, num_output_channels=output_channels,
+                                              cache_dir=os.path.join(WORKING_DIR, 'pix2pix_out', 'generator_cache'),
+                                              **gen_params)
+    else:
+        generator_nn = UNETGenerator(input_img_dim=input_img_dim, num_output_channels=output_channels, **gen_params)
+    generator_nn.summary()
+
+    # ----------------------
+    # PATCH GAN DISCRIMINATOR
+    # the patch gan averages loss across sub patches of the image
+    # it's fancier than the standard gan but produces sharper results
+    # ----------------------
+    discriminator_nn = PatchGanDiscriminator(output_img_dim=output_img_dim,
+            patch_dim=patch_gan_dim, nb_patches=nb_patch_patches)
+    discriminator_nn.summary()
+
+    # disable training while we put it through the GAN
+    discriminator_nn.trainable = False
+
+    # ------------------------
+    # Define Optimizers
+    opt_discriminator = Adam(learning_rate=1E-4, beta_1=0.9, beta_2=0.999, epsilon=1e-08)
+    opt_dcgan = Adam(learning_rate=1E-4, beta_1=0.9, beta_2=0.999, epsilon=1e-08)
+
+    # -------------------------
+    # compile generator
+    generator_nn.compile(loss='mae', optimizer=opt_discriminator)
+
+    # ----------------------
+    # MAKE FULL DCGAN
+    # ----------------------
+    dc_gan_nn = DCGAN(generator_model=generator_nn,
+                      discriminator_model=discriminator_nn,
+                      input_img_dim=input_img_dim,
+                      patch_dim=sub_patch_dim)
+
+    dc_gan_nn.summary()
+
+    # ---------------------
+    # Compile DCGAN
+    # we use a combination of mae and bin_crossentropy
+    loss = ['mae', 'binary_crossentropy']
+    loss_weights = [1E2, 1]
+    dc_gan_nn.compile(loss=loss, loss_weights=loss_weights, optimizer=opt_dcgan)
+
+    # ---------------------
+    # ENABLE DISCRIMINATOR AND COMPILE
+    discriminator_nn.trainable = True
+    discriminator_nn.compile(loss='binary_crossentropy', optimizer=opt_discriminator)
 
 # ------------------------
 # RUN ACTUAL TRAINING
-batch_size = 1
 data_path = WORKING_DIR + '/data/' + DATASET
 nb_epoch = 100
 n_images_per_epoch = 400
@@ -103,19 +161,19 @@ for epoch in range(0, nb_epoch):
     print('Epoch {}'.format(epoch))
     batch_counter = 1
     start = time.time()
-    progbar = keras_generic_utils.Progbar(n_images_per_epoch)
+    progbar = Progbar(n_images_per_epoch)
 
     # init the datasources again for each epoch
-    tng_gen = facades_generator(data_dir_name=data_path, data_type='training', im_width=im_width, batch_size=batch_size)
-    val_gen = facades_generator(data_dir_name=data_path, data_type='validation', im_width=im_width, batch_size=batch_size)
+    tng_gen = iter(facades_dataset(data_dir_name=data_path, data_type='training', im_width=im_width, batch_size=batch_size))
+    val_gen = iter(facades_dataset(data_dir_name=data_path, data_type='validation', im_width=im_width, batch_size=batch_size))
 
     # go through 1... n_images_per_epoch (which will go through all buckets as well
     for mini_batch_i in range(0, n_images_per_epoch, batch_size):
 
         # load a batch of decoded and original images
         # both for training and validation
-        X_train_decoded_imgs, X_train_original_imgs = next(tng_gen)
-        X_val_decoded_imgs, X_val_original_imgs = next(val_gen)
+        X_train_decoded_imgs, X_train_original_imgs = [X.numpy() for X in next(tng_gen)]
+        X_val_decoded_imgs, X_val_original_imgs = [X.numpy() for X in next(val_gen)]
 
         # generate a batch of data and feed to the discriminator
         # some images that come out of here are real and some are fake
@@ -1,5 +1,5 @@
-from keras.layers import Input, Lambda
-from keras.models import Model
+from tensorflow.keras.layers import Input, Lambda
+from tensorflow.keras.models import Model
 
 
 def DCGAN(generator_model, discriminator_model, input_img_dim, patch_dim):
@@ -26,7 +26,7 @@ def DCGAN(generator_model, discriminator_model, input_img_dim, patch_dim):
     # generated image model from the generator
     generated_image = generator_model(generator_input)
 
-    h, w = input_img_dim[1:]
+    h, w = input_img_dim[:2]
     ph, pw = patch_dim
 
     # chop the generated image into patches
@@ -36,13 +36,13 @@ def DCGAN(generator_model, discriminator_model, input_img_dim, patch_dim):
     list_gen_patch = []
     for row_idx in list_row_idx:
         for col_idx in list_col_idx:
-            x_patch = Lambda(lambda z: z[:, :, row_idx[0]:row_idx[1],
-                col_idx[0]:col_idx[1]], output_shape=input_img_dim)(generated_image)
+            x_patch = Lambda(lambda z: z[:, row_idx[0]:row_idx[1],
+                col_idx[0]:col_idx[1], :], output_shape=input_img_dim)(generated_image)
             list_gen_patch.append(x_patch)
 
     # measure loss from patches of the image (not the actual image)
     dcgan_output = discriminator_model(list_gen_patch)
 
     # actually turn into keras model
-    dc_gan = Model(input=[generator_input], output=[generated_image, dcgan_output], name="DCGAN")
+    dc_gan = Model(inputs=generator_input, outputs=[generated_image, dcgan_output], name="DCGAN")
     return dc_gan
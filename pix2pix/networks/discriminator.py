@@ -1,9 +1,6 @@
-from keras.layers import Flatten, Dense, Input, Reshape, merge, Lambda
-from keras.layers.convolutional import Convolution2D
-from keras.layers.normalization import BatchNormalization
-from keras.layers.advanced_activations import LeakyReLU
-from keras.models import Model
-import keras.backend as K
+from tensorflow.keras.layers import Flatten, Dense, Input, Reshape, Concatenate, Lambda, Conv2D, BatchNormalization, LeakyReLU
+from tensorflow.keras.models import Model
+import tensorflow.keras.backend as K
 import numpy as np
 
 def PatchGanDiscriminator(output_img_dim, patch_dim, nb_patches):
@@ -26,7 +23,7 @@ def PatchGanDiscriminator(output_img_dim, patch_dim, nb_patches):
     2. Calculates the cost for each patch
     3. Returns the avg of the costs as the output of the network
 
-    :param patch_dim: (channels, width, height) T
+    :param patch_dim: (width, height, channels)
     :param nb_patches:
     :return:
     """
@@ -37,20 +34,19 @@ def PatchGanDiscriminator(output_img_dim, patch_dim, nb_patches):
     # 1 layer block = Conv - BN - LeakyRelu
     # -------------------------------
     stride = 2
-    bn_mode = 2
-    axis = 1
+    axis = -1
     input_layer = Input(shape=patch_dim)
 
     # We have to build the discriminator dinamically because
     # the size of the disc patches is dynamic
     num_filters_start = 64
-    nb_conv = int(np.floor(np.log(output_img_dim[1]) / np.log(2)))
+    nb_conv = int(np.floor(np.log(output_img_dim[0]) / np.log(2)))
     filters_list = [num_filters_start * min(8, (2 ** i)) for i in range(nb_conv)]
 
     # CONV 1
     # Do first conv bc it is different from the rest
     # paper skips batch norm for first layer
-    disc_out = Convolution2D(nb_filter=64, nb_row=4, nb_col=4, border_mode='same', subsample=(stride, stride), name='disc_conv_1')(input_layer)
+    disc_out = Conv2D(filters=64, kernel_size=(4, 4), padding='same', strides=(stride, stride), name='disc_conv_1')(input_layer)
     disc_out = LeakyReLU(alpha=0.2)(disc_out)
 
     # CONV 2 - CONV N
@@ -58,8 +54,8 @@ def PatchGanDiscriminator(output_img_dim, patch_dim, nb_patches):
     for i, filter_size in enumerate(filters_list[1:]):
         name = 'disc_conv_{}'.format(i+2)
 
-        disc_out = Convolution2D(nb_filter=filter_size, nb_row=4, nb_col=4, border_mode='same', subsample=(stride, stride), name=name)(disc_out)
-        disc_out = BatchNormalization(name=name + '_bn', mode=bn_mode, axis=axis)(disc_out)
+        disc_out = Conv2D(filters=filter_size, kernel_size=(4, 4), padding='same', strides=(stride, stride), name=name)(disc_out)
+        disc_out = BatchNormalization(name=name + '_bn', axis=axis)(disc_out)
         disc_out = LeakyReLU(alpha=0.2)(disc_out)
 
     # ------------------------
@@ -82,7 +78,7 @@ def generate_patch_gan_loss(last_disc_conv_layer, patch_dim, input_layer, nb_pat
     x_flat = Flatten()(last_disc_conv_layer)
     x = Dense(2, activation='softmax', name="disc_dense")(x_flat)
 
-    patch_gan = Model(input=[input_layer], output=[x, x_flat], name="patch_gan")
+    patch_gan = Model(inputs=input_layer, outputs=[x, x_flat], name="patch_gan")
 
     # generate individual losses for each patch
     x = [patch_gan(patch)[0] for patch in list_input]
@@ -90,7 +86,7 @@ def generate_patch_gan_loss(last_disc_conv_layer, patch_dim, input_layer, nb_pat
 
     # merge layers if have multiple patches (aka perceptual loss)
     if len(x) > 1:
-        x = merge(x, mode="concat", name="merged_features")
+        x = Concatenate(name="merged_features")(x)
     else:
         x = x[0]
 
@@ -98,24 +94,25 @@ def generate_patch_gan_loss(last_disc_conv_layer, patch_dim, input_layer, nb_pat
     # mbd = mini batch discrimination
     # https://arxiv.org/pdf/1606.03498.pdf
     if len(x_mbd) > 1:
-        x_mbd = merge(x_mbd, mode="concat", name="merged_feature_mbd")
+        x_mbd = Concatenate(name="merged_feature_mbd")(x_mbd)
     else:
         x_mbd = x_mbd[0]
 
     num_kernels = 100
     dim_per_kernel = 5
 
-    M = Dense(num_kernels * dim_per_kernel, bias=False, activation=None)
+    M = Dense(num_kernels * dim_per_kernel, use_bias=False, activation=None)
     MBD = Lambda(minb_disc, output_shape=lambda_output)
 
     x_mbd = M(x_mbd)
     x_mbd = Reshape((num_kernels, dim_per_kernel))(x_mbd)
     x_mbd = MBD(x_mbd)
-    x = merge([x, x_mbd], mode='concat')
+    x = Concatenate()([x, x_mbd])
 
-    x_out = Dense(2, activation="softmax", name="disc_output")(x)
+    # keep the softmax in float32 when training with mixed precision
+    x_out = Dense(2, activation="softmax", name="disc_output", dtype='float32')(x)
 
-    discriminator = Model(input=list_input, output=[x_out], name='discriminator_nn')
+    discriminator = Model(inputs=list_input, outputs=[x_out], name='discriminator_nn')
     return discriminator
 
 
@@ -1,8 +1,14 @@
-from keras.layers import Activation, Input, Dropout, Concatenate, Conv2D
-from keras.layers.convolutional import Convolution2D, UpSampling2D
-from keras.layers.normalization import BatchNormalization
-from keras.layers.advanced_activations import LeakyReLU
-from keras.models import Model
+import functools
+import hashlib
+import os
+import shutil
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+from tensorflow.keras.layers import Activation, Input, Dropout, Concatenate, Conv2D, Conv2DTranspose, BatchNormalization
+from tensorflow.keras.models import Model
+import tensorflow.keras.backend as K
+from . import layers
+from .layers import DepthToSpace, ConvBnLRelu
 
 """
 There are two models available for the generator:
@@ -10,12 +16,93 @@ There are two models available for the generator:
 2. UNet with skip connections
 """
 
+# filters of the UNet encoder/decoder blocks (decoder has no block for the innermost encoder)
+# [https://arxiv.org/pdf/1611.07004v1.pdf][5. Appendix]
+UNET_ENCODER_FILTERS = [64, 128, 256, 512, 512, 512, 512, 512]
+UNET_DECODER_FILTERS = [512, 512, 512, 512, 256, 128, 64]
 
-def make_generator_ae(input_layer, num_output_filters):
+
+def upsample_conv(x, filters, kernel_size=(4, 4), use_bias=True, upsampling='deconv'):
+    """
+    Doubles the feature map and convolves it without materializing a 4x larger upsampled input.
+    'deconv': strided transposed conv, upsamples and convolves in one op (as in the paper).
+    'subpixel': conv with 4x the filters on the small map, then a pixel shuffle (DepthToSpace).
+        Costs more FLOPs than 'deconv' but doesn't produce its checkerboard artifacts.
+
+    :param x: input tensor
+    :param filters: number of output channels
+    :param kernel_size: conv kernel size
+    :param use_bias: add a bias to the conv
+    :param upsampling: 'deconv' or 'subpixel'
+    :return:
+    """
+    if upsampling == 'deconv':
+        return Conv2DTranspose(filters=filters, kernel_size=kernel_size, padding='same', strides=(2, 2), use_bias=use_bias)(x)
+
+    if upsampling == 'subpixel':
+        x = Conv2D(filters=4 * filters, kernel_size=kernel_size, padding='same', use_bias=use_bias)(x)
+        return DepthToSpace(block_size=2)(x)
+
+    raise ValueError('Unknown upsampling: {}'.format(upsampling))
+
+
+def conv_bn_act(x, filters, use_bn=True, dropout=False, activation=None, bn_name=None, kernel_size=(4, 4),
+                upsampling='deconv'):
+    """
+    Decoder block shared by both generators: Upsampling conv - BN - Activation - (Dropout).
+    Doubles the feature map with upsample_conv (the encoders use ConvBnLRelu).
+
+    When batch norm follows, the conv is built without a bias (BN's beta already shifts
+    the output) so the block is the plain conv - FusedBatchNorm - Activation chain
+    that tensorflow's grappler remapper and XLA fuse into a single kernel.
+    Dropout goes after the activation to keep it out of that chain (the order doesn't
+    matter mathematically, dropout only scales by a positive factor).
+
+    :param x: input tensor
+    :param filters: number of conv filters
+    :param use_bn: add batch norm after the conv
+    :param dropout: add dropout (0.5) after the activation
+    :param activation: keras activation name or None to leave the output linear
+    :param bn_name: name of the batch norm layer
+    :param kernel_size: conv kernel size
+    :param upsampling: decoder upsampling, see upsample_conv
+    :return:
+    """
+    x = upsample_conv(x, filters, kernel_size=kernel_size, use_bias=not use_bn, upsampling=upsampling)
+
+    if use_bn:
+        x = BatchNormalization(name=bn_name, axis=-1)(x)
+
+    if activation is not None:
+        x = Activation(activation)(x)
+
+    if dropout:
+        x = Dropout(0.5)(x)
+
+    return x
+
+
+def merge_skip(x, skip):
+    """
+    Appends a (relu activated) encoder skip connection to the activated decoder output.
+    Since relu(concat(x, skip)) == concat(relu(x), relu(skip)), activating before the merge
+    lets the decoder relu fuse with its batch norm and leaves the concat as a plain
+    channel append and the last op of the block.
+
+    :param x: relu activated decoder output
+    :param skip: matching encoder output
+    :return:
+    """
+    skip = Activation('relu')(skip)
+    return Concatenate(axis=-1)([x, skip])
+
+
+def make_generator_ae(input_layer, num_output_filters, kernel_size=(4, 4)):
     """
     Creates the generator according to the specs in the paper below.
     [https://arxiv.org/pdf/1611.07004v1.pdf][5. Appendix]
     :param model:
+    :param kernel_size: conv kernel size, see UNETGenerator
     :return:
     """
     # -------------------------------
@@ -23,181 +110,207 @@ def make_generator_ae(input_layer, num_output_filters):
     # C64-C128-C256-C512-C512-C512-C512-C512
     # 1 layer block = Conv - BN - LeakyRelu
     # -------------------------------
-    stride = 2
     filter_sizes = [64, 128, 256, 512, 512, 512, 512, 512]
 
     encoder = input_layer
     for filter_size in filter_sizes:
-        encoder = Conv2D(filters=filter_size, kernel_size=(4, 4), padding='same', strides=(stride, stride))(encoder)
         # paper skips batch norm for first layer
-        if filter_size != 64:
-            encoder = BatchNormalization()(encoder)
-        encoder = Activation(LeakyReLU(alpha=0.2))(encoder)
+        encoder = ConvBnLRelu(filter_size, kernel_size=kernel_size, use_bn=filter_size != 64)(encoder)
 
     # -------------------------------
     # DECODER
     # CD512-CD512-CD512-C512-C512-C256-C128-C64
-    # 1 layer block = Conv - Upsample - BN - DO - Relu
+    # 1 layer block = Deconv - BN - Relu - DO
     # -------------------------------
-    stride = 2
     filter_sizes = [512, 512, 512, 512, 512, 256, 128, 64]
 
     decoder = encoder
     for filter_size in filter_sizes:
-        decoder = UpSampling2D(size=(2, 2))(decoder)
-        decoder = Conv2D(filters=filter_size, kernel_size=(4, 4), padding='same')(decoder)
-        decoder = BatchNormalization()(decoder)
-        decoder = Dropout(0.5)(decoder)
-        decoder = Activation('relu')(decoder)
+        decoder = conv_bn_act(decoder, filter_size, dropout=True, activation='relu',
+                              kernel_size=kernel_size)
 
     # After the last layer in the decoder, a convolution is applied
     # to map to the number of output channels (3 in general,
     # except in colorization, where it is 2), followed by a Tanh
-    # function.
-    decoder = Conv2D(filters=num_output_filters, kernel_size=(4, 4), padding='same')(decoder)
-    generator = Activation('tanh')(decoder)
+    # function. Tanh is kept in float32 when training with mixed precision.
+    decoder = Conv2D(filters=num_output_filters, kernel_size=kernel_size, padding='same')(decoder)
+    generator = Activation('tanh', dtype='float32')(decoder)
     return generator
 
 
-def UNETGenerator(input_img_dim, num_output_channels):
+def unet_encoder(input_layer, filter_sizes=UNET_ENCODER_FILTERS, kernel_size=(4, 4), nb_recompute=0):
     """
-    Creates the generator according to the specs in the paper below.
-    It's basically a skip layer AutoEncoder
+    Encoder half of the UNETGenerator.
+    Every block only depends on the block before it, all the outputs are returned
+    so the decoder can consume them as skip connections.
 
-    Generator does the following:
-    1. Takes in an image
-    2. Generates an image from this image
-
-    Differs from a standard GAN because the image isn't random.
-    This model tries to learn a mapping from a suboptimal image to an optimal image.
-
-    [https://arxiv.org/pdf/1611.07004v1.pdf][5. Appendix]
-    :param input_img_dim: (channel, height, width)
-    :param output_img_dim: (channel, height, width)
-    :return:
+    :param input_layer: image input
+    :param filter_sizes: filters of each encoder block
+    :param kernel_size: conv kernel size
+    :param nb_recompute: number of deepest blocks that recompute their activations in the
+        backward pass instead of keeping them (gradient checkpointing, see ConvBnLRelu)
+    :return: [en_1, ..., en_n]
     """
     # -------------------------------
     # ENCODER
     # C64-C128-C256-C512-C512-C512-C512-C512
     # 1 layer block = Conv - BN - LeakyRelu
     # -------------------------------
-    stride = 2
-    merge_mode = 'concat'
-
-    # batch norm merge axis
-    bn_axis = 1
-
-    input_layer = Input(shape=input_img_dim, name="unet_input")
-
-    # 1 encoder C64
-    # skip batchnorm on this layer on purpose (from paper)
-    en_1 = Conv2D(filters=64, kernel_size=(4, 4), padding='same', strides=(stride, stride))(input_layer)
-    en_1 = LeakyReLU(alpha=0.2)(en_1)
-
-    # 2 encoder C128
-    en_2 = Conv2D(filters=128, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_1)
-    en_2 = BatchNormalization(name='gen_en_bn_2', axis=bn_axis)(en_2)
-    en_2 = LeakyReLU(alpha=0.2)(en_2)
-
-    # 3 encoder C256
-    en_3 = Conv2D(filters=256, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_2)
-    en_3 = BatchNormalization(name='gen_en_bn_3', axis=bn_axis)(en_3)
-    en_3 = LeakyReLU(alpha=0.2)(en_3)
-
-    # 4 encoder C512
-    en_4 = Conv2D(filters=512, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_3)
-    en_4 = BatchNormalization(name='gen_en_bn_4', axis=bn_axis)(en_4)
-    en_4 = LeakyReLU(alpha=0.2)(en_4)
-
-    # 5 encoder C512
-    en_5 = Conv2D(filters=1024, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_4)
-    en_5 = BatchNormalization(name='gen_en_bn_5', axis=bn_axis)(en_5)
-    en_5 = LeakyReLU(alpha=0.2)(en_5)
-
-    # 6 encoder C512
-    en_6 = Conv2D(filters=512, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_5)
-    en_6 = BatchNormalization(name='gen_en_bn_6', axis=bn_axis)(en_6)
-    en_6 = LeakyReLU(alpha=0.2)(en_6)
-
-    # 7 encoder C512
-    en_7 = Conv2D(filters=512, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_6)
-    en_7 = BatchNormalization(name='gen_en_bn_7', axis=bn_axis)(en_7)
-    en_7 = LeakyReLU(alpha=0.2)(en_7)
-
-    # 8 encoder C512
-    en_8 = Conv2D(filters=512, kernel_size=(4, 4), padding='same', strides=(stride, stride))(en_7)
-    en_8 = BatchNormalization(name='gen_en_bn_8', axis=bn_axis)(en_8)
-    en_8 = LeakyReLU(alpha=0.2)(en_8)
+    encoders = [input_layer]
+    for i, filter_size in enumerate(filter_sizes):
+        # skip batchnorm on the first layer on purpose (from paper)
+        use_bn = i > 0
+        recompute = i >= len(filter_sizes) - nb_recompute
+        encoder = ConvBnLRelu(filter_size, kernel_size=kernel_size, use_bn=use_bn, recompute=recompute,
+                              name='gen_en_{}'.format(i + 1))
+        encoders.append(encoder(encoders[-1]))
+
+    return encoders[1:]
+
+
+def unet_decoder(encoders, num_output_channels, filter_sizes=UNET_DECODER_FILTERS, dropout=True, kernel_size=(4, 4),
+                 upsampling='deconv'):
+    """
+    Decoder half of the UNETGenerator.
+    Each block takes the previous block output and its matching encoder output, the skips
+    are popped off the encoder outputs in order. The encoder outputs stay alive until
+    their decoder block, so the network can't be cut into independent sequential stages.
+
+    :param encoders: outputs of unet_encoder
+    :param num_output_channels: channels of the generated image
+    :param filter_sizes: filters of each decoder block, one less than the encoder blocks
+    :param dropout: add dropout to the decoder blocks (leave it out for inference)
+    :param kernel_size: deconv kernel size
+    :param upsampling: 'deconv' or 'subpixel', see upsample_conv
+    :return: generated image
+    """
+    assert len(filter_sizes) == len(encoders) - 1, 'need one decoder block per skip connection'
+    skips = list(encoders[:-1])
 
     # -------------------------------
     # DECODER
-    # CD512-CD1024-CD1024-C1024-C1024-C512-C256-C128
-    # 1 layer block = Conv - Upsample - BN - DO - Relu
+    # CD1024-CD1024-CD1024-CD1024-CD512-CD256-CD128
+    # (channels after appending the skip, the deconvs output 512-512-512-512-256-128-64)
+    # 1 layer block = Deconv (or Conv - DepthToSpace) - BN - Relu - DO
     # also adds skip connections (merge). Takes input from previous layer matching encoder layer
     # -------------------------------
-    # 1 decoder CD512 (decodes en_8)
-    de_1 = UpSampling2D(size=(2, 2))(en_8)
-    de_1 = Conv2D(filters=512, kernel_size=(4, 4), padding='same')(de_1)
-    de_1 = BatchNormalization(name='gen_de_bn_1', axis=bn_axis)(de_1)
-    de_1 = Dropout(0.5)(de_1)
-    de_1 = Concatenate(axis=1)([de_1, en_7])
-    de_1 = Activation('relu')(de_1)
-
-    # 2 decoder CD1024 (decodes en_7)
-    de_2 = UpSampling2D(size=(2, 2))(de_1)
-    de_2 = Conv2D(filters=512, kernel_size=(4, 4), padding='same')(de_2)
-    de_2 = BatchNormalization(name='gen_de_bn_2', axis=bn_axis)(de_2)
-    de_2 = Dropout(0.5)(de_2)
-    de_2 = Concatenate(axis=1)([de_2, en_6])
-    de_2 = Activation('relu')(de_2)
-
-    # 3 decoder CD1024 (decodes en_6)
-    de_3 = UpSampling2D(size=(2, 2))(de_2)
-    de_3 = Conv2D(filters=1024, kernel_size=(4, 4), padding='same')(de_3)
-    de_3 = BatchNormalization(name='gen_de_bn_3', axis=bn_axis)(de_3)
-    de_3 = Dropout(0.5)(de_3)
-    de_3 = Concatenate(axis=1)([de_3, en_5])
-    de_3 = Activation('relu')(de_3)
-
-    # 4 decoder CD1024 (decodes en_5)
-    de_4 = UpSampling2D(size=(2, 2))(de_3)
-    de_4 = Conv2D(filters=512, kernel_size=(4, 4), padding='same')(de_4)
-    de_4 = BatchNormalization(name='gen_de_bn_4', axis=bn_axis)(de_4)
-    de_4 = Dropout(0.5)(de_4)
-    de_4 = Concatenate(axis=1)([de_4, en_4])
-    de_4 = Activation('relu')(de_4)
-
-    # 5 decoder CD1024 (decodes en_4)
-    de_5 = UpSampling2D(size=(2, 2))(de_4)
-    de_5 = Conv2D(filters=256, kernel_size=(4, 4), padding='same')(de_5)
-    de_5 = BatchNormalization(name='gen_de_bn_5', axis=bn_axis)(de_5)
-    de_5 = Dropout(0.5)(de_5)
-    de_5 = Concatenate(axis=1)([de_5, en_3])
-    de_5 = Activation('relu')(de_5)
-
-    # 6 decoder C512 (decodes en_3)
-    de_6 = UpSampling2D(size=(2, 2))(de_5)
-    de_6 = Conv2D(filters=128, kernel_size=(4, 4), padding='same')(de_6)
-    de_6 = BatchNormalization(name='gen_de_bn_6', axis=bn_axis)(de_6)
-    de_6 = Dropout(0.5)(de_6)
-    de_6 = Concatenate(axis=1)([de_6, en_2])
-    de_6 = Activation('relu')(de_6)
-
-    # 7 decoder CD256 (decodes en_2)
-    de_7 = UpSampling2D(size=(2, 2))(de_6)
-    de_7 = Conv2D(filters=64, kernel_size=(4, 4), padding='same')(de_7)
-    de_7 = BatchNormalization(name='gen_de_bn_7', axis=bn_axis)(de_7)
-    de_7 = Dropout(0.5)(de_7)
-    de_7 = Concatenate(axis=1)([de_7, en_1])
-    de_7 = Activation('relu')(de_7)
+    decoder = encoders[-1]
+    for i, filter_size in enumerate(filter_sizes):
+        bn_name = 'gen_de_bn_{}'.format(i + 1)
+        decoder = conv_bn_act(decoder, filter_size, dropout=dropout, activation='relu', bn_name=bn_name,
+                              kernel_size=kernel_size, upsampling=upsampling)
+        decoder = merge_skip(decoder, skips.pop())
 
     # After the last layer in the decoder, a convolution is applied
     # to map to the number of output channels (3 in general,
     # except in colorization, where it is 2), followed by a Tanh
-    # function.
-    de_8 = UpSampling2D(size=(2, 2))(de_7)
-    de_8 = Conv2D(filters=num_output_channels, kernel_size=(4, 4), padding='same')(de_8)
-    de_8 = Activation('tanh')(de_8)
+    # function. Tanh is kept in float32 when training with mixed precision.
+    decoder = upsample_conv(decoder, num_output_channels, kernel_size=kernel_size, upsampling=upsampling)
+    decoder = Activation('tanh', dtype='float32')(decoder)
+    return decoder
+
+
+def UNETGenerator(input_img_dim, num_output_channels,
+                  encoder_filters=UNET_ENCODER_FILTERS, decoder_filters=UNET_DECODER_FILTERS, for_inference=False,
+                  kernel_size=(4, 4), upsampling='deconv', recompute_encoders=0, batch_size=None):
+    """
+    Creates the generator according to the specs in the paper below.
+    It's basically a skip layer AutoEncoder
+
+    Generator does the following:
+    1. Takes in an image
+    2. Generates an image from this image
+
+    Differs from a standard GAN because the image isn't random.
+    This model tries to learn a mapping from a suboptimal image to an optimal image.
+
+    [https://arxiv.org/pdf/1611.07004v1.pdf][5. Appendix]
+    Expects channels last data, set it with K.set_image_data_format('channels_last')
+    (the default for the tensorflow backend) before building the model.
+
+    :param input_img_dim: (height, width, channel)
+    :param num_output_channels: channels of the generated image
+    :param encoder_filters: filters of each encoder block (the depth of the UNet)
+    :param decoder_filters: filters of each decoder block, one less than the encoder blocks
+    :param for_inference: build without the dropout layers (identity at inference anyway),
+        for exporting (ONNX/TensorRT). Weights of a training model load into it as is.
+    :param kernel_size: conv kernel size, (4, 4) in the paper. (3, 3) is ~44% fewer FLOPs per conv,
+        but with 'deconv' upsampling the uneven overlap of its stride 2 deconvs causes checkerboard artifacts.
+        With 'subpixel' the decoder convs are stride 1, (3, 3) is artifact free and Winograd eligible there.
+    :param upsampling: decoder upsampling, 'deconv' (paper) or 'subpixel', see upsample_conv
+    :param recompute_encoders: number of deepest encoder blocks to recompute in the backward pass
+        (gradient checkpointing), frees their activation memory for larger batches while training
+    :param batch_size: static batch size of the input (per replica when training distributed),
+        lets XLA specialize on a single shape. None accepts any batch size
+    :return:
+    """
+    assert K.image_data_format() == 'channels_last', 'UNETGenerator expects channels_last data'
+
+    input_layer = Input(shape=input_img_dim, batch_size=batch_size, name="unet_input")
+    encoders = unet_encoder(input_layer, encoder_filters, kernel_size=kernel_size, nb_recompute=recompute_encoders)
+    output = unet_decoder(encoders, num_output_channels, decoder_filters, dropout=not for_inference,
+                          kernel_size=kernel_size, upsampling=upsampling)
+
+    unet_generator = Model(inputs=input_layer, outputs=output, name='unet_generator')
+    return unet_generator
+
+
+def get_or_build_generator(input_img_dim, num_output_channels, cache_dir, **kwargs):
+    """
+    Returns a UNETGenerator, built only once per shape/config.
+    The built model is serialized as a SavedModel in cache_dir (one per input shape,
+    output channels, UNETGenerator kwargs, mixed precision policy and version of the
+    generator code) and loaded from there on the next runs, within a run the same
+    model instance is returned again. Only the latest entry per input shape and output
+    channels is kept, building another config or code version evicts the older ones.
+
+    The loaded model has the initial weights of the first build, so every run using it
+    starts from the same init. Use it to skip the build when serving/exporting, train
+    from a fresh UNETGenerator.
+
+    :param input_img_dim: (height, width, channel)
+    :param num_output_channels: channels of the generated image
+    :param cache_dir: dir of the serialized models
+    :param kwargs: other UNETGenerator params
+    :return: the UNETGenerator
+    """
+    # lru_cache needs hashable args
+    config = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()))
+    policy = mixed_precision.global_policy().name
+    return _load_or_build_generator(tuple(input_img_dim), num_output_channels, cache_dir, config, policy)
+
+
+def _source_hash():
+    """
+    :return: hash of the generator and layers code, any change to the architecture invalidates the cache
+    """
+    md5 = hashlib.md5()
+    for module_file in (__file__, layers.__file__):
+        with open(os.path.splitext(module_file)[0] + '.py', 'rb') as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+@functools.lru_cache(maxsize=4)
+def _load_or_build_generator(input_img_dim, num_output_channels, cache_dir, config, policy):
+    key = (config, policy, _source_hash())
+    config_hash = hashlib.md5(repr(key).encode('utf-8')).hexdigest()[:8]
+    cache_path = os.path.join(cache_dir, 'unet_generator_{}_{}_{}'.format(
+        'x'.join(str(d) for d in input_img_dim), num_output_channels, config_hash))
+
+    if os.path.isdir(cache_path):
+        return tf.keras.models.load_model(cache_path, custom_objects={'DepthToSpace': DepthToSpace,
+                                                                      'ConvBnLRelu': ConvBnLRelu})
+
+    # evict the entries of other configs/code versions for this shape
+    prefix = os.path.basename(cache_path)[:-len(config_hash)]
+    if os.path.isdir(cache_dir):
+        for entry in os.listdir(cache_dir):
+            if entry.startswith(prefix):
+                shutil.rmtree(os.path.join(cache_dir, entry))
+
+    unet_generator = UNETGenerator(input_img_dim, num_output_channels, **dict(config))
 
-    unet_generator = Model(input=[input_layer], output=[de_8], name='unet_generator')
-    return unet_generator
\ No newline at end of file
+    serving_fn = tf.function(unet_generator, input_signature=[tf.TensorSpec(shape=(None,) + input_img_dim, dtype=tf.float32)])
+    unet_generator.save(cache_path, save_format='tf', signatures={'serving_default': serving_fn.get_concrete_function()})
+    return unet_generator
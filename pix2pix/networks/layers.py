@@ -0,0 +1,116 @@
+from tensorflow.keras.layers import Layer, Conv2D, BatchNormalization
+import tensorflow as tf
+
+
+class DepthToSpace(Layer):
+    """
+    Pixel shuffle (ESPCN, https://arxiv.org/abs/1609.05158).
+    Moves blocks of block_size^2 channels into block_size x block_size spatial blocks,
+    (batch, h, w, c * block_size^2) -> (batch, h * block_size, w * block_size, c).
+    It's a pure index rearrangement, nothing is duplicated in memory like with UpSampling2D.
+    """
+
+    def __init__(self, block_size=2, **kwargs):
+        super(DepthToSpace, self).__init__(**kwargs)
+        self.block_size = block_size
+
+    def call(self, inputs):
+        return tf.nn.depth_to_space(inputs, self.block_size)
+
+    def compute_output_shape(self, input_shape):
+        batch, height, width, channels = input_shape
+        height = height * self.block_size if height is not None else None
+        width = width * self.block_size if width is not None else None
+        return batch, height, width, channels // (self.block_size ** 2)
+
+    def get_config(self):
+        config = {'block_size': self.block_size}
+        base_config = super(DepthToSpace, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class ConvBnLRelu(Layer):
+    """
+    Strided Conv - BN - LeakyRelu encoder block as a single layer.
+    The leaky relu is a plain tf.nn.leaky_relu on the batch norm output instead of a
+    separate keras layer, so XLA sees (and fuses) the three ops as one chain.
+
+    With recompute=True the block's activations are not kept for the backward pass,
+    they are recomputed from the block input (tf.recompute_grad) instead. This trades
+    one extra forward pass of the block for the memory of its activations, use it on the
+    deep blocks where the convs are cheap compared to the memory they pin.
+    The recomputed function normalizes with the batch statistics without touching the
+    batch norm moving statistics, those are updated once outside of it the way
+    BatchNormalization updates them (tests/test_layers.py checks both paths match).
+    A frozen batch norm (trainable=False) runs in inference mode like the keras layer.
+    """
+
+    def __init__(self, filters, kernel_size=(4, 4), strides=(2, 2), use_bn=True, alpha=0.2, recompute=False, **kwargs):
+        super(ConvBnLRelu, self).__init__(**kwargs)
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        self.use_bn = use_bn
+        self.alpha = alpha
+        self.recompute = recompute
+
+        # no conv bias when batch norm follows, BN's beta already shifts the output
+        self.conv = Conv2D(filters=filters, kernel_size=kernel_size, padding='same', strides=strides, use_bias=not use_bn)
+        self.bn = BatchNormalization(axis=-1) if use_bn else None
+
+    def build(self, input_shape):
+        # built here since the recompute path uses the batch norm weights without calling it
+        self.conv.build(input_shape)
+        if self.bn is not None:
+            self.bn.build(self.conv.compute_output_shape(input_shape))
+        super(ConvBnLRelu, self).build(input_shape)
+
+    def _block(self, inputs, training=None):
+        x = self.conv(inputs)
+        if self.bn is not None:
+            x = self.bn(x, training=training)
+        return tf.nn.leaky_relu(x, alpha=self.alpha)
+
+    def _batch_stats_block(self, inputs):
+        """
+        Training forward of the block without side effects, so it can run twice.
+        :return: block output, batch mean, unbiased batch variance (for the moving variance)
+        """
+        x = self.conv(inputs)
+        x32 = tf.cast(x, tf.float32)
+        mean, variance = tf.nn.moments(x32, axes=[0, 1, 2])
+        outputs = tf.nn.batch_normalization(x32, mean, variance, self.bn.beta, self.bn.gamma, self.bn.epsilon)
+
+        # the fused batch norm keras uses updates the moving variance with Bessel's correction
+        nb_values = tf.cast(tf.reduce_prod(tf.shape(x32)[:3]), tf.float32)
+        variance = variance * nb_values / tf.maximum(nb_values - 1., 1.)
+        return tf.nn.leaky_relu(tf.cast(outputs, x.dtype), alpha=self.alpha), mean, variance
+
+    def call(self, inputs, training=None):
+        if not (self.recompute and training):
+            return self._block(inputs, training=training)
+
+        # no batch norm updates to keep out of the recompute (a frozen BN runs in inference mode)
+        if self.bn is None or not self.bn.trainable:
+            return tf.recompute_grad(lambda x: self._block(x, training=training))(inputs)
+
+        outputs, mean, variance = tf.recompute_grad(self._batch_stats_block)(inputs)
+
+        # moving statistics updated once per step, same as BatchNormalization does
+        decay = 1. - self.bn.momentum
+        self.bn.moving_mean.assign_sub((self.bn.moving_mean - tf.stop_gradient(mean)) * decay)
+        self.bn.moving_variance.assign_sub((self.bn.moving_variance - tf.stop_gradient(variance)) * decay)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        return self.conv.compute_output_shape(input_shape)
+
+    def get_config(self):
+        config = {'filters': self.filters,
+                  'kernel_size': self.kernel_size,
+                  'strides': self.strides,
+                  'use_bn': self.use_bn,
+                  'alpha': self.alpha,
+                  'recompute': self.recompute}
+        base_config = super(ConvBnLRelu, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
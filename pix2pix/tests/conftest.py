@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def float32_channels_last():
+    """
+    Runs the test under the float32 policy with channels last data,
+    the previous global policy and image data format are restored after it.
+    """
+    from tensorflow.keras import mixed_precision
+    import tensorflow.keras.backend as K
+
+    policy, data_format = mixed_precision.global_policy(), K.image_data_format()
+    mixed_precision.set_global_policy('float32')
+    K.set_image_data_format('channels_last')
+    yield
+    mixed_precision.set_global_policy(policy)
+    K.set_image_data_format(data_format)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from tensorflow.keras.layers import BatchNormalization
+
+from pix2pix.networks.generator import UNETGenerator
+from pix2pix.networks.layers import ConvBnLRelu
+from pix2pix.utils.inference_utils import fold_bn
+
+
+def _randomize_bn(model, rng):
+    """
+    Sets random gamma/beta/moving stats on every batch norm, fresh ones fold to the identity.
+    """
+    bns = [layer for layer in model.layers if isinstance(layer, BatchNormalization)]
+    bns += [layer.bn for layer in model.layers if isinstance(layer, ConvBnLRelu) and layer.bn is not None]
+    for bn in bns:
+        channels = bn.gamma.shape[0]
+        bn.set_weights([rng.uniform(0.5, 1.5, channels).astype(np.float32),
+                        rng.uniform(-0.5, 0.5, channels).astype(np.float32),
+                        rng.uniform(-0.5, 0.5, channels).astype(np.float32),
+                        rng.uniform(0.5, 1.5, channels).astype(np.float32)])
+    return len(bns)
+
+
+@pytest.mark.usefixtures('float32_channels_last')
+@pytest.mark.parametrize('upsampling', ['deconv', 'subpixel'])
+@pytest.mark.parametrize('kernel_size', [(4, 4), (3, 3)])
+def test_fold_bn_matches_original(upsampling, kernel_size):
+    rng = np.random.RandomState(0)
+
+    model = UNETGenerator(input_img_dim=(32, 32, 1), num_output_channels=1,
+                          encoder_filters=[8, 16, 16, 16], decoder_filters=[16, 16, 8],
+                          for_inference=True, kernel_size=kernel_size, upsampling=upsampling)
+    assert _randomize_bn(model, rng) > 0
+    folded_model = fold_bn(model)
+
+    # every batch norm got folded, the ConvBnLRelu ones inside their block
+    assert not any(isinstance(layer, BatchNormalization) for layer in folded_model.layers)
+    assert all(layer.bn is None for layer in folded_model.layers if isinstance(layer, ConvBnLRelu))
+
+    x = rng.uniform(0., 1., (2, 32, 32, 1)).astype(np.float32)
+    np.testing.assert_allclose(folded_model(x, training=False).numpy(), model(x, training=False).numpy(),
+                               rtol=1e-4, atol=1e-5)
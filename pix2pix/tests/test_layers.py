@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from pix2pix.networks.layers import ConvBnLRelu
+
+
+def _train_step(recompute, use_bn=True, bn_trainable=True):
+    """
+    One training forward/backward pass of a ConvBnLRelu with fixed random weights.
+    :return: outputs, gradients (input and trainable weights), moving statistics
+    """
+    rng = np.random.RandomState(0)
+    block = ConvBnLRelu(8, kernel_size=(3, 3), use_bn=use_bn, recompute=recompute)
+    block.build((2, 8, 8, 3))
+
+    block.conv.kernel.assign(rng.normal(0., 0.5, block.conv.kernel.shape).astype(np.float32))
+    if use_bn:
+        block.bn.gamma.assign(rng.uniform(0.5, 1.5, 8).astype(np.float32))
+        block.bn.beta.assign(rng.uniform(-0.5, 0.5, 8).astype(np.float32))
+        block.bn.moving_mean.assign(rng.uniform(-0.5, 0.5, 8).astype(np.float32))
+        block.bn.moving_variance.assign(rng.uniform(0.5, 1.5, 8).astype(np.float32))
+        block.bn.trainable = bn_trainable
+
+    x = tf.constant(rng.uniform(-1., 1., (2, 8, 8, 3)).astype(np.float32))
+    with tf.GradientTape() as tape:
+        tape.watch(x)
+        outputs = block(x, training=True)
+        loss = tf.reduce_sum(outputs * outputs)
+
+    grads = tape.gradient(loss, [x] + block.trainable_weights)
+    moving_stats = [block.bn.moving_mean, block.bn.moving_variance] if use_bn else []
+    return [outputs] + grads + moving_stats
+
+
+@pytest.mark.usefixtures('float32_channels_last')
+@pytest.mark.parametrize('use_bn, bn_trainable', [(True, True), (True, False), (False, True)])
+def test_recompute_matches_plain_block(use_bn, bn_trainable):
+    expected = _train_step(recompute=False, use_bn=use_bn, bn_trainable=bn_trainable)
+    actual = _train_step(recompute=True, use_bn=use_bn, bn_trainable=bn_trainable)
+
+    assert len(actual) == len(expected)
+    for actual_value, expected_value in zip(actual, expected):
+        np.testing.assert_allclose(np.asarray(actual_value), np.asarray(expected_value), rtol=1e-4, atol=1e-5)
@@ -1,4 +1,4 @@
-from keras.utils.data_utils import get_file
+from tensorflow.keras.utils import get_file
 import os
 import subprocess
 
@@ -1,11 +1,12 @@
 import os
 import numpy as np
 import h5py
+import tensorflow as tf
 
 def normalize(X):
     return X / 255.0
 
-def facades_generator(data_dir_name, data_type, im_width, batch_size=10):
+def facades_generator(data_dir_name, data_type, im_width, batch_size=10, raw=False):
     """
     Generates facades and target images
     X = decoded images
@@ -14,6 +15,7 @@ def facades_generator(data_dir_name, data_type, im_width, batch_size=10):
     :param data_dir_name: Absolute path location of the data folder
     :param data_type: Can be 'training', 'testing', 'validation'
     :param batch_size: Batch size for training
+    :param raw: yield the uint8 pixels as read, without normalizing them
     :return:
     """
     data_dir = data_dir_name + '/' + data_type
@@ -42,12 +44,40 @@ def facades_generator(data_dir_name, data_type, im_width, batch_size=10):
                 i_end = i + batch_size
 
                 # slice the specific batch that we want and output it through the generator
-                x_batch_facades = np.array(facade_images['data'][i: i_end], dtype=np.float32)
-                x_batch_facades = x_batch_facades.reshape((len(x_batch_facades), 1, width, height))
-                x_batch_facades = normalize(x_batch_facades)
+                dtype = np.uint8 if raw else np.float32
+                x_batch_facades = np.array(facade_images['data'][i: i_end], dtype=dtype)
+                x_batch_facades = x_batch_facades.reshape((len(x_batch_facades), width, height, 1))
 
-                y_batch_images = np.array(target_images['data'][i: i_end], dtype=np.float32)
-                y_batch_images = y_batch_images.reshape((len(y_batch_images), 1, width, height))
-                y_batch_images = normalize(y_batch_images)
+                y_batch_images = np.array(target_images['data'][i: i_end], dtype=dtype)
+                y_batch_images = y_batch_images.reshape((len(y_batch_images), width, height, 1))
 
-                yield x_batch_facades, y_batch_images
\ No newline at end of file
+                if not raw:
+                    x_batch_facades = normalize(x_batch_facades)
+                    y_batch_images = normalize(y_batch_images)
+
+                yield x_batch_facades, y_batch_images
+
+
+def facades_dataset(data_dir_name, data_type, im_width, batch_size=10):
+    """
+    tf.data pipeline around facades_generator.
+    The h5 buckets are read (as uint8, in a single python thread) in the background,
+    the cast and normalization run as a parallel map outside of the GIL and batches are
+    prefetched while the networks train on the current one. All batches have exactly
+    batch_size images (buckets don't have to be a multiple of the batch size), so models
+    can be built with a static batch dim.
+
+    :param data_dir_name: Absolute path location of the data folder
+    :param data_type: Can be 'training', 'testing', 'validation'
+    :param batch_size: Batch size for training
+    :return: dataset of (decoded images, original images) batches
+    """
+    img_spec = tf.TensorSpec(shape=(None, im_width, im_width, 1), dtype=tf.uint8)
+    dataset = tf.data.Dataset.from_generator(
+        lambda: facades_generator(data_dir_name, data_type, im_width, batch_size=batch_size, raw=True),
+        output_signature=(img_spec, img_spec))
+
+    dataset = dataset.unbatch().batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(lambda x, y: (normalize(tf.cast(x, tf.float32)), normalize(tf.cast(y, tf.float32))),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,179 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, Conv2DTranspose
+from tensorflow.keras.models import Model
+import tensorflow.keras.backend as K
+
+
+def make_xla_predict(model):
+    """
+    Wraps the forward pass of a model in an XLA compiled function for deployment.
+    XLA fuses the elementwise ops (BN, activations, upsampling) into the convs around
+    them which cuts most of the kernel launches on the small bottleneck feature maps.
+
+    The function is compiled on the first call and again for every new input shape,
+    so keep the batch shape fixed.
+
+    :param model: keras model (ie: the UNETGenerator)
+    :return: function taking a batch of images and returning the model output
+    """
+    @tf.function(jit_compile=True)
+    def infer(x):
+        return model(x, training=False)
+
+    return infer
+
+
+def fold_bn(model):
+    """
+    Folds every BatchNormalization that directly follows a Conv2D/Conv2DTranspose
+    (optionally through a DepthToSpace pixel shuffle), as well as the batch norm of
+    ConvBnLRelu blocks, into the kernel and bias of that conv, for inference:
+        W' = W * gamma / sigma
+        b' = (b - mean) * gamma / sigma + beta      (sigma = sqrt(moving_var + epsilon))
+    The batch norm layers are dropped from the returned model, which saves one kernel
+    and one read/write of the activation per batch norm. The input model is not modified.
+
+    Call it on a trained model once, before saving/exporting it.
+
+    :param model: trained keras functional model (ie: the UNETGenerator)
+    :return: new model without the folded batch norms
+    """
+    config = model.get_config()
+    layers_by_name = {layer.name: layer for layer in model.layers}
+    configs_by_name = {layer_config['name']: layer_config for layer_config in config['layers']}
+
+    # how often each layer output is consumed, a layer can only be folded through if the BN is its only consumer
+    nb_consumers = {}
+    for layer_config in config['layers']:
+        for node in layer_config['inbound_nodes']:
+            for inbound in node:
+                nb_consumers[inbound[0]] = nb_consumers.get(inbound[0], 0) + 1
+
+    def single_inbound(layer_name):
+        nodes = configs_by_name[layer_name]['inbound_nodes']
+        if len(nodes) != 1 or len(nodes[0]) != 1:
+            return None
+        inbound_name = nodes[0][0][0]
+        return inbound_name if nb_consumers[inbound_name] == 1 else None
+
+    # bn name -> name of the layer feeding it, conv name -> (bn name, number of times the bn params repeat)
+    folds = {}
+    folded_convs = {}
+    for layer_config in config['layers']:
+        if layer_config['class_name'] != 'BatchNormalization':
+            continue
+
+        bn = layers_by_name[layer_config['name']]
+        bn_axis = bn.axis if isinstance(bn.axis, int) else bn.axis[0]
+        inbound_name = single_inbound(bn.name)
+        if bn_axis not in (-1, 3) or inbound_name is None:
+            continue
+
+        # the pixel shuffle maps conv channel c to output channel c % (filters / block_size^2)
+        conv_name, repeat = inbound_name, 1
+        if configs_by_name[inbound_name]['class_name'] == 'DepthToSpace':
+            conv_name, repeat = single_inbound(inbound_name), layers_by_name[inbound_name].block_size ** 2
+
+        if conv_name is not None and isinstance(layers_by_name[conv_name], (Conv2D, Conv2DTranspose)):
+            folds[bn.name] = inbound_name
+            folded_convs[conv_name] = (bn.name, repeat)
+
+    # blocks with their own batch norm are rebuilt without it
+    folded_blocks = []
+    for layer_config in config['layers']:
+        if layer_config['class_name'] == 'ConvBnLRelu' and layer_config['config']['use_bn']:
+            layer_config['config']['use_bn'] = False
+            folded_blocks.append(layer_config['name'])
+
+    # drop the batch norms and rewire their consumers to the layers feeding them
+    def rewire(refs):
+        for ref in refs:
+            ref[0] = folds.get(ref[0], ref[0])
+
+    config['layers'] = [l for l in config['layers'] if l['name'] not in folds]
+    for layer_config in config['layers']:
+        for node in layer_config['inbound_nodes']:
+            rewire(node)
+        if layer_config['name'] in folded_convs:
+            layer_config['config']['use_bias'] = True
+    rewire(config['output_layers'])
+
+    custom_objects = {type(layer).__name__: type(layer) for layer in model.layers}
+    folded_model = Model.from_config(config, custom_objects=custom_objects)
+
+    for layer in folded_model.layers:
+        if layer.name in folded_convs:
+            bn_name, repeat = folded_convs[layer.name]
+            layer.set_weights(_fold_conv_bn(layers_by_name[layer.name], layers_by_name[bn_name], repeat))
+        elif layer.name in folded_blocks:
+            block = layers_by_name[layer.name]
+            layer.set_weights(_fold_conv_bn(block.conv, block.bn))
+        else:
+            layer.set_weights(layers_by_name[layer.name].get_weights())
+
+    return folded_model
+
+
+def _fold_conv_bn(conv, bn, repeat=1):
+    """
+    :param repeat: how often the bn params repeat over the conv filters (block_size^2 for a pixel shuffle)
+    :return: [kernel, bias] of the conv with the batch norm folded in
+    """
+    kernel = K.get_value(conv.kernel)
+    bias = K.get_value(conv.bias) if conv.use_bias else np.zeros(conv.filters, dtype=kernel.dtype)
+
+    gamma = K.get_value(bn.gamma) if bn.scale else 1.0
+    beta = K.get_value(bn.beta) if bn.center else 0.0
+    scale = gamma / np.sqrt(K.get_value(bn.moving_variance) + bn.epsilon)
+    shift = beta - K.get_value(bn.moving_mean) * scale
+
+    scale = np.tile(scale, repeat)
+    shift = np.tile(shift, repeat)
+
+    # Conv2D kernels are (h, w, in, out), Conv2DTranspose kernels are (h, w, out, in)
+    if isinstance(conv, Conv2DTranspose):
+        kernel = kernel * scale[:, np.newaxis]
+    else:
+        kernel = kernel * scale
+
+    return [kernel, bias * scale + shift]
+
+
+def convert_to_tflite_int8(model, calibration_images, tflite_path):
+    """
+    Post training int8 quantization of a model to TFLite, for edge devices.
+    The batch norms are folded into the convs first so only the folded conv weights
+    get quantized. The final tanh is left out of the quantization and runs in float32
+    (like in build_trt_engine), inputs and outputs stay float32 as well.
+    Needs tensorflow 2.7+ (tf.lite.experimental.QuantizationDebugger).
+
+    :param model: trained keras model (ie: the UNETGenerator built with for_inference=True),
+        built under the float32 policy, mixed precision casts don't quantize
+    :param calibration_images: a few hundred training images (batch, height, width, channel)
+        used to calibrate the activation ranges
+    :param tflite_path: where to write the .tflite model
+    :return: tflite_path
+    """
+    if any(layer.dtype_policy.compute_dtype != 'float32' for layer in model.layers):
+        raise ValueError('Build the model under the float32 policy to quantize it '
+                         '(mixed_precision.set_global_policy("float32") then load the weights)')
+
+    def representative_dataset():
+        for img in calibration_images:
+            yield [np.asarray(img[np.newaxis], dtype=np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(fold_bn(model))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    # int8 kernels everywhere, the float builtins only for the ops left unquantized (tanh)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+
+    debugger = tf.lite.experimental.QuantizationDebugger(
+        converter=converter, debug_dataset=representative_dataset,
+        debug_options=tf.lite.experimental.QuantizationDebugOptions(denylisted_ops=['TANH']))
+
+    with open(tflite_path, 'wb') as f:
+        f.write(debugger.get_nondebug_quantized_model())
+
+    return tflite_path
@@ -18,11 +18,11 @@ def plot_generated_batch(X_full, X_sketch, generator_model, epoch_num, dataset_n
     Xg = X_gen[:8]
     Xr = X_full[:8]
 
-    # put |decoded, generated, original| images next to each other
-    X = np.concatenate((Xs, Xg, Xr), axis=3)
+    # put |decoded, generated, original| images next to each other (along the width)
+    X = np.concatenate((Xs, Xg, Xr), axis=2)
 
     # make one giant block of images
-    X = np.concatenate(X, axis=1)
+    X = np.concatenate(X, axis=0)
 
     # save the giant n x 3 images
-    plt.imsave('./pix2pix_out/progress_imgs/{}_epoch_{}_batch_{}.png'.format(dataset_name, epoch_num, batch_num), X[0], cmap='Greys_r')
+    plt.imsave('./pix2pix_out/progress_imgs/{}_epoch_{}_batch_{}.png'.format(dataset_name, epoch_num, batch_num), X[:, :, 0], cmap='Greys_r')
@@ -1,7 +1,7 @@
 import numpy as np
 
 
-def num_patches(output_img_dim=(3, 256, 256), sub_patch_dim=(64, 64)):
+def num_patches(output_img_dim=(256, 256, 3), sub_patch_dim=(64, 64)):
     """
     Creates non-overlaping patches to feed to the PATCH GAN
     (Section 2.2.2 in paper)
@@ -17,10 +17,10 @@ def num_patches(output_img_dim=(3, 256, 256), sub_patch_dim=(64, 64)):
     :return:
     """
     # num of non-overlaping patches
-    nb_non_overlaping_patches = (output_img_dim[1] / sub_patch_dim[0]) * (output_img_dim[2] / sub_patch_dim[1])
+    nb_non_overlaping_patches = (output_img_dim[0] / sub_patch_dim[0]) * (output_img_dim[1] / sub_patch_dim[1])
 
     # dimensions for the patch discriminator
-    patch_disc_img_dim = (output_img_dim[0], sub_patch_dim[0], sub_patch_dim[1])
+    patch_disc_img_dim = (sub_patch_dim[0], sub_patch_dim[1], output_img_dim[2])
 
     return int(nb_non_overlaping_patches), patch_disc_img_dim
 
@@ -32,11 +32,11 @@ def extract_patches(images, sub_patch_dim):
     ex: input 3 images [im1, im2, im3]
     output [[im_1_patch_1, im_2_patch_1], ... , [im_n-1_patch_k, im_n_patch_k]]
 
-    :param images: array of Images (num_images, im_channels, im_height, im_width)
+    :param images: array of Images (num_images, im_height, im_width, im_channels)
     :param sub_patch_dim: (height, width) ex: (30, 30) Subpatch dimensions
     :return:
     """
-    im_height, im_width = images.shape[2:]
+    im_height, im_width = images.shape[1:3]
     patch_height, patch_width = sub_patch_dim
 
     # list out all xs  ex: 0, 29, 58, ...
@@ -49,9 +49,9 @@ def extract_patches(images, sub_patch_dim):
     for y in y_spots:
         for x in x_spots:
             # indexing here is cra
-            # images[num_images, num_channels, width, height]
+            # images[num_images, height, width, num_channels]
             # this says, cut a patch across all images at the same time with this width, height
-            image_patches = images[:, :, y: y+patch_height, x: x+patch_width]
+            image_patches = images[:, y: y+patch_height, x: x+patch_width, :]
             all_patches.append(np.asarray(image_patches, dtype=np.float32))
     return all_patches
 
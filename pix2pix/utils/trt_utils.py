@@ -0,0 +1,193 @@
+import os
+import numpy as np
+import tensorflow as tf
+import tf2onnx
+import tensorrt as trt
+import pycuda.autoinit  # noqa: F401 (creates the CUDA context on import)
+import pycuda.driver as cuda
+
+TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+
+
+def build_trt_engine(keras_model, onnx_path, plan_path, precision='fp16', max_batch=4,
+                     calibration_images=None, calibration_cache=None):
+    """
+    Converts a keras model to ONNX and builds a serialized TensorRT engine (.plan) from it.
+    Convolutions then run on tensor cores with the algorithms TensorRT picks for this GPU.
+
+    The engine is specific to the GPU and the image shape it was built on, so build it
+    once per GPU and reuse the .plan file afterwards (see UNETGeneratorTRT).
+    Build it for the largest image you expect (a UNETGenerator built with that
+    input_img_dim loads the trained weights as is), smaller images get mirror padded
+    to that shape at predict time instead of needing a new engine.
+
+    :param keras_model: Trained keras model (ie: the UNETGenerator)
+    :param onnx_path: Where to write the intermediate ONNX model
+    :param plan_path: Where to write the serialized TensorRT engine
+    :param precision: 'fp32', 'fp16', 'bf16' (bf16 needs Ampere or newer) or 'int8' (needs calibration_images)
+    :param max_batch: Largest batch size the engine will accept
+    :param calibration_images: int8 only, a few hundred training images (batch, height, width, channel)
+        to calibrate the activation ranges. Fold the batch norms first (inference_utils.fold_bn)
+    :param calibration_cache: int8 only, file to reuse/store the calibration scales
+    :return: plan_path
+    """
+    # keras -> onnx, with a dynamic batch dim
+    img_shape = tuple(keras_model.input_shape[1:])
+    input_signature = (tf.TensorSpec((None,) + img_shape, tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, output_path=onnx_path)
+
+    # onnx -> tensorrt network
+    builder = trt.Builder(TRT_LOGGER)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, TRT_LOGGER)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError('Failed to parse {}: {}'.format(onnx_path, '\n'.join(errors)))
+
+    config = builder.create_builder_config()
+    if precision == 'fp16':
+        config.set_flag(trt.BuilderFlag.FP16)
+    elif precision == 'bf16':
+        config.set_flag(trt.BuilderFlag.BF16)
+    elif precision == 'int8':
+        if calibration_images is None and calibration_cache is None:
+            raise ValueError('int8 needs calibration_images or a calibration_cache')
+        # layers without int8 kernels fall back to fp16
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.set_flag(trt.BuilderFlag.FP16)
+        config.int8_calibrator = UNETEntropyCalibrator(calibration_images, batch_size=max_batch,
+                                                       cache_path=calibration_cache)
+
+        # keep the output (tanh) in fp32
+        output_name = network.get_output(0).name
+        for i in range(network.num_layers):
+            layer = network.get_layer(i)
+            if layer.get_output(0).name == output_name:
+                layer.precision = trt.float32
+                layer.set_output_type(0, trt.float32)
+        config.set_flag(trt.BuilderFlag.OBEY_PRECISION_CONSTRAINTS)
+    elif precision != 'fp32':
+        raise ValueError('Unknown precision: {}'.format(precision))
+
+    # the image dims are fixed by the model, only the batch dim is dynamic
+    input_tensor = network.get_input(0)
+    profile = builder.create_optimization_profile()
+    profile.set_shape(input_tensor.name, (1,) + img_shape, (max_batch,) + img_shape, (max_batch,) + img_shape)
+    config.add_optimization_profile(profile)
+    if precision == 'int8':
+        config.set_calibration_profile(profile)
+
+    plan = builder.build_serialized_network(network, config)
+    if plan is None:
+        raise RuntimeError('Failed to build the TensorRT engine')
+
+    with open(plan_path, 'wb') as f:
+        f.write(plan)
+
+    return plan_path
+
+
+class UNETEntropyCalibrator(trt.IInt8EntropyCalibrator2):
+    """
+    Feeds batches of training images to TensorRT to calibrate the int8 activation ranges.
+    The scales are cached to cache_path (if given) so later builds skip the calibration.
+    """
+
+    def __init__(self, images, batch_size=4, cache_path=None):
+        trt.IInt8EntropyCalibrator2.__init__(self)
+        self.images = None if images is None else np.ascontiguousarray(images, dtype=np.float32)
+        self.batch_size = batch_size
+        self.cache_path = cache_path
+        self.batch_i = 0
+        self.d_batch = None if images is None else cuda.mem_alloc(self.images[:batch_size].nbytes)
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_batch(self, names):
+        if self.images is None or self.batch_i + self.batch_size > len(self.images):
+            return None
+
+        batch = self.images[self.batch_i: self.batch_i + self.batch_size]
+        cuda.memcpy_htod(self.d_batch, batch)
+        self.batch_i += self.batch_size
+        return [int(self.d_batch)]
+
+    def read_calibration_cache(self):
+        if self.cache_path is not None and os.path.isfile(self.cache_path):
+            with open(self.cache_path, 'rb') as f:
+                return f.read()
+        return None
+
+    def write_calibration_cache(self, cache):
+        if self.cache_path is not None:
+            with open(self.cache_path, 'wb') as f:
+                f.write(cache)
+
+
+class UNETGeneratorTRT(object):
+    """
+    Runs a UNETGenerator engine built with build_trt_engine.
+    Host (page-locked) and device buffers are allocated once for the max batch size
+    so predict doesn't allocate anything on each call.
+
+    Images smaller than the engine shape are mirror padded (centered) up to it and the
+    padding is cropped off the output, so one engine serves every image size.
+    Only those padded images get mirrored borders instead of the conv zero padding, an
+    image of the engine shape is run as is. To get rid of the edge artifacts build the
+    engine with a margin (ie: 512x512 for 256x256 images, padded by 128 on every side).
+    """
+
+    def __init__(self, plan_path):
+        runtime = trt.Runtime(TRT_LOGGER)
+        with open(plan_path, 'rb') as f:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = cuda.Stream()
+
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.input_name = [n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT][0]
+        self.output_name = [n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT][0]
+
+        # max shape of the optimization profile
+        max_input_shape = tuple(self.engine.get_tensor_profile_shape(self.input_name, 0)[2])
+        self.max_batch = max_input_shape[0]
+        self.context.set_input_shape(self.input_name, max_input_shape)
+        max_output_shape = tuple(self.context.get_tensor_shape(self.output_name))
+
+        self.h_input = cuda.pagelocked_empty(max_input_shape, dtype=np.float32)
+        self.h_output = cuda.pagelocked_empty(max_output_shape, dtype=np.float32)
+        self.d_input = cuda.mem_alloc(self.h_input.nbytes)
+        self.d_output = cuda.mem_alloc(self.h_output.nbytes)
+
+        self.context.set_tensor_address(self.input_name, int(self.d_input))
+        self.context.set_tensor_address(self.output_name, int(self.d_output))
+
+    def predict(self, img):
+        """
+        :param img: Batch of images (batch, height, width, channel), at most the dims the engine was built for
+        :return: Generated images, same height/width as img
+        """
+        nb_imgs, height, width = img.shape[:3]
+        if nb_imgs > self.max_batch:
+            raise ValueError('Batch of {} is larger than the engine max batch {}'.format(nb_imgs, self.max_batch))
+
+        engine_height, engine_width = self.h_input.shape[1:3]
+        if height > engine_height or width > engine_width:
+            raise ValueError('Image of {}x{} is larger than the engine shape {}x{}'.format(
+                height, width, engine_height, engine_width))
+
+        # mirror pad up to the engine shape
+        top = (engine_height - height) // 2
+        left = (engine_width - width) // 2
+        pad = ((0, 0), (top, engine_height - height - top), (left, engine_width - width - left), (0, 0))
+        self.h_input[:nb_imgs] = np.pad(img, pad, mode='reflect')
+        self.context.set_input_shape(self.input_name, self.h_input[:nb_imgs].shape)
+
+        cuda.memcpy_htod_async(self.d_input, self.h_input[:nb_imgs], self.stream)
+        self.context.execute_async_v3(self.stream.handle)
+        cuda.memcpy_dtoh_async(self.h_output[:nb_imgs], self.d_output, self.stream)
+        self.stream.synchronize()
+
+        return np.array(self.h_output[:nb_imgs, top:top + height, left:left + width])